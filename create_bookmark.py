@@ -5,11 +5,11 @@
     根据文本中的缩进层级和页码，自动为PDF添加多级书签(Outlines)，
     并处理物理页码与逻辑页码的偏移量。
 实现原理:
-    1. 使用 PyPDF2 读取原始 PDF。
+    1. 使用 pypdf (或旧版 PyPDF2) 读取原始 PDF。
     2. 解析 toc.txt，利用正则表达式分离标题和页码，利用缩进判断层级。
     3. 使用栈 (Stack) 结构来管理父子书签关系。
     4. 保存为新的 PDF 文件。
-依赖库: PyPDF2 (pip install PyPDF2)
+依赖库: pypdf (pip install pypdf)，无 pypdf 时兼容旧版 PyPDF2
 使用方法:
     python create_bookmark.py <input_pdf> <toc_file> <output_pdf> <page_offset>
     
@@ -23,13 +23,106 @@
 import re
 import sys
 import os
+import mmap
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from math import gcd
-from functools import reduce
-from PyPDF2 import PdfReader, PdfWriter
+# pypdf 是 PyPDF2 的持续维护分支，页面复制与写出等热路径明显更快;
+# 未安装 pypdf 的旧环境退回 PyPDF2 (两者 3.x API 兼容)
+try:
+    from pypdf import PdfReader, PdfWriter
+    from pypdf.generic import (
+        ArrayObject,
+        DictionaryObject,
+        NameObject,
+        NumberObject,
+        TextStringObject,
+    )
+except ImportError:
+    from PyPDF2 import PdfReader, PdfWriter
+    from PyPDF2.generic import (
+        ArrayObject,
+        DictionaryObject,
+        NameObject,
+        NumberObject,
+        TextStringObject,
+    )
+
+# 可选加速依赖: numpy/numba 仅用于超大目录(上万行，如索引)的数值批处理，
+# 未安装时自动退回纯 Python 实现，不影响功能
+try:
+    import numpy as np
+except ImportError:
+    np = None
+try:
+    from numba import njit
+except ImportError:
+    njit = None
 
 # 常量: Tab 转换为多少个空格
 TAB_SIZE = 4
 
+# 目录行数超过该阈值才启用批处理路径 (否则数组构建/编译开销得不偿失)
+BATCH_MIN_LINES = 10_000
+
+if np is not None and njit is not None:
+    @njit(cache=True)
+    def _levels_and_dests(indent_sizes, page_numbers, indent_unit, page_offset, total_pages):
+        """
+        数值紧循环: 批量计算每行的层级、目标页索引及其有效性。
+        字符串解析(正则/切分)对 Numba 不友好，留在纯 Python 中完成，
+        这里只编译整数运算部分; cache=True 将编译结果缓存到磁盘。
+        """
+        n = indent_sizes.shape[0]
+        levels = np.empty(n, dtype=np.int32)
+        dests = np.empty(n, dtype=np.int32)
+        valid = np.empty(n, dtype=np.bool_)
+        for i in range(n):
+            levels[i] = indent_sizes[i] // indent_unit
+            d = page_numbers[i] - 1 + page_offset
+            dests[i] = d
+            valid[i] = 0 <= d < total_pages
+        return levels, dests, valid
+
+# 目录行格式: "<标题> <页码>"
+# 在模块层面预编译，避免每行匹配时重复查询 re 模块的模式缓存;
+# 非贪婪的 .*? 配合行尾锚点也避免了病态标题导致的灾难性回溯
+_TOC_RE = re.compile(r'^(.*?)\s+(\d+)\s*$')
+
+def _scan_toc(toc_path):
+    """
+    单次流式扫描目录文件: 逐行读取的同时增量更新缩进 GCD，
+    并缓存 (行号, 缩进宽度, 内容) 供主循环使用，
+    避免 readlines() 整体物化后再做第二遍缩进扫描。
+
+    返回 (parsed_lines, running_gcd, min_indent)。
+    """
+    parsed_lines = []
+    running_gcd = 0
+    min_indent = 0
+    with open(toc_path, 'r', encoding='utf-8') as f:
+        line_num = 0
+        for raw_line in f:
+            line_num += 1
+            # expandtabs 每次调用都要遍历并复制整行，
+            # 因此只展开一次，缩进和内容都从展开结果派生
+            expanded = raw_line.expandtabs(TAB_SIZE)  # 将Tab转换为空格
+            stripped_line = expanded.strip()
+            if not stripped_line:
+                continue
+            # 单次 strip 即可: 首个非空白字符在展开行中的位置就是缩进宽度，
+            # 省掉 lstrip/rstrip 各分配一个中间字符串
+            indent_size = expanded.index(stripped_line[0])
+            if indent_size > 0:
+                # GCD 单调递减且几行内即收敛，降到 1 后不可能再变，
+                # 跳过剩余行的 gcd 调用 (此时会改用 min_indent 作单位)
+                if running_gcd != 1:
+                    running_gcd = gcd(running_gcd, indent_size)
+                if min_indent == 0 or indent_size < min_indent:
+                    min_indent = indent_size
+            parsed_lines.append((line_num, indent_size, stripped_line))
+    return parsed_lines, running_gcd, min_indent
+
 def add_bookmarks(pdf_path, toc_path, output_path, page_offset):
     """
     为PDF文件添加书签
@@ -51,113 +144,244 @@ def add_bookmarks(pdf_path, toc_path, output_path, page_offset):
     if output_dir and not os.path.exists(output_dir):
         raise FileNotFoundError(f"输出目录不存在: {output_dir}")
     
-    try:
+    def _open_reader():
         # 读取PDF文件
-        reader = PdfReader(pdf_path)
-        
-        # 检查PDF是否加密
-        if reader.is_encrypted:
-            raise ValueError(f"PDF文件已加密，无法处理: {pdf_path}")
-        
-        total_pages = len(reader.pages)
-        print(f"PDF文件总页数: {total_pages}")
-        
-    except Exception as e:
-        raise ValueError(f"无法读取PDF文件 {pdf_path}: {str(e)}")
-    
-    writer = PdfWriter()
+        # 以内存映射方式打开: xref 驱动的随机访问只按需换入被引用的对象，
+        # 避免标准文件对象的双重缓冲，降低超大PDF的峰值内存
+        # (注意: mm 需保持存活直到 writer.write 完成)
+        f_in = open(pdf_path, 'rb')
+        mm = mmap.mmap(f_in.fileno(), 0, access=mmap.ACCESS_READ)
+        return f_in, mm, PdfReader(mm)
 
-    # 将所有页面复制到 writer 对象
-    for page in reader.pages:
-        writer.add_page(page)
+    # PDF 的 xref 解析与目录文件的读取扫描相互独立，且文件 I/O 期间
+    # 都会释放 GIL，用双线程并发执行把目录扫描藏在 PDF 解析的延迟里
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        reader_future = executor.submit(_open_reader)
+        toc_future = executor.submit(_scan_toc, toc_path)
 
-    # 用于存储父书签对象的栈
-    # parent_stack 存储的是 (bookmark_object, level_index)
-    parent_stack = [] 
+        try:
+            f_in, mm, reader = reader_future.result()
 
-    try:
-        with open(toc_path, 'r', encoding='utf-8') as f:
-            lines = f.readlines()
-    except Exception as e:
-        raise ValueError(f"无法读取目录文件 {toc_path}: {str(e)}")
-
-    # 检测缩进单位
-    indent_sizes = []
-    for raw_line in lines:
-        expanded = raw_line.expandtabs(TAB_SIZE)  # 将Tab转换为空格
-        stripped = expanded.lstrip()
-        if not stripped:
-            continue
-        indent_size = len(expanded) - len(stripped)
-        if indent_size > 0:
-            indent_sizes.append(indent_size)
+            # 检查PDF是否加密
+            if reader.is_encrypted:
+                raise ValueError(f"PDF文件已加密，无法处理: {pdf_path}")
+
+            total_pages = len(reader.pages)
+            print(f"PDF文件总页数: {total_pages}")
+
+        except Exception as e:
+            raise ValueError(f"无法读取PDF文件 {pdf_path}: {str(e)}")
+
+        try:
+            parsed_lines, running_gcd, min_indent = toc_future.result()
+        except Exception as e:
+            raise ValueError(f"无法读取目录文件 {toc_path}: {str(e)}")
+
+    writer = PdfWriter()
+
+    # 将所有页面批量复制到 writer 对象
+    # 相比逐页 add_page，append_pages_from_reader 复用 reader 的对象树，
+    # 避免在 Python 层对每个页面及其引用对象做深拷贝，大幅降低大文件的耗时和内存
+    # (注意: reader 需保持存活直到 writer.write 完成，以便解析间接引用)
+    writer.append_pages_from_reader(reader)
+
+    # 按层级索引的父书签数组: 层级是一个小的有界整数(深度很少超过6)，
+    # parents[level] 直接记录该层最近的书签节点下标，取父节点为 O(1)，
+    # 免去元组栈每行的弹栈比较和元组分配
+    parents = [None] * 16
+    last_level = -1
 
     # 使用最大公约数 (GCD) 来检测缩进单位，如果没有检测到或GCD太小则使用默认值4
-    if indent_sizes:
-        indent_unit = reduce(gcd, indent_sizes)
+    if running_gcd:
+        indent_unit = running_gcd
         # 如果GCD为1，则可能是混合缩进或不规则缩进，使用最小缩进作为单位
         if indent_unit == 1:
-            indent_unit = min(indent_sizes)
+            indent_unit = min_indent
     else:
         indent_unit = 4
     print(f"检测到的缩进单位: {indent_unit} 个空格")
 
-    line_num = 0
-    for line in lines:
-        line_num += 1
-        line = line.rstrip()
-        stripped_line = line.strip()
-        if not stripped_line:
-            continue
+    # 层级计算特化: 缩进单位几乎总是 2 的幂 (2/4/8)，
+    # 此时用右移代替整除，走 CPython 更便宜的整数路径
+    if indent_unit & (indent_unit - 1) == 0:
+        _shift = indent_unit.bit_length() - 1
+        level_of = lambda size, _s=_shift: size >> _s
+    else:
+        level_of = lambda size, _u=indent_unit: size // _u
 
-        # 1. 计算缩进级别
-        expanded = line.expandtabs(TAB_SIZE)  # 将Tab转换为空格
-        indent_size = len(expanded) - len(expanded.lstrip())
-        level = indent_size // indent_unit
+    # 逐行消息先积攒起来，循环结束后一次性输出，
+    # 避免每个书签触发一次 print (控制台逐行刷新+编码转换非常慢)
+    log_lines = []
+
+    # 热循环微优化: 把循环内反复用到的全局名/方法属性绑定为局部变量，
+    # 让字节码走 LOAD_FAST 而不是每次迭代的 LOAD_GLOBAL/LOAD_ATTR
+    toc_match = _TOC_RE.match
+    log_append = log_lines.append
+    _int = int
+
+    # 1. 提取标题和页码 (字符串部分，纯 Python)
+    entries = []  # (行号, 缩进宽度, 标题, 页码)
+    entries_append = entries.append
+    for line_num, indent_size, stripped_line in parsed_lines:
+        # 快速路径: 绝大多数目录行都是 "<标题> <页码>" 的简单形式，
+        # 用 C 实现的 rpartition/isdecimal 即可分离，无需每行启动正则引擎
+        head, sep, tail = stripped_line.rpartition(' ')
+        if sep and tail.isdecimal():
+            title = head.rstrip()
+            page_num_str = tail
+        else:
+            # 回退: 用正则处理制表符分隔、页码后带空白等不规则行
+            match = toc_match(stripped_line)
+            if not match:
+                log_append(f"警告: 第 {line_num} 行格式不正确，已跳过: {stripped_line}")
+                continue
+            title = match.group(1).strip()
+            page_num_str = match.group(2)
+        # 页码在上面已验证为纯数字，_int 走 LOAD_FAST 直接交给 C 级解析
+        entries_append((line_num, indent_size, title, _int(page_num_str)))
+
+    # 2. 批量计算层级与实际页码 (数值部分)
+    # 逻辑页码 (书上印的) + 偏移量 = 物理页码 (PDF阅读器里的从0开始的索引)
+    # pypdf 的 add_outline_item 接受的页码索引从 0 开始
+    # 超大目录走批处理: 有 numba 时用编译后的紧循环，
+    # 否则退一级用 NumPy 向量化 (C/SIMD) 一次算完，免去逐行解释执行;
+    # 两者都不可用或目录较小时留在主循环中逐行计算
+    batch = None
+    if np is not None and len(entries) > BATCH_MIN_LINES:
+        indent_arr = np.fromiter((e[1] for e in entries), dtype=np.int32, count=len(entries))
+        page_arr = np.fromiter((e[3] for e in entries), dtype=np.int32, count=len(entries))
+        if njit is not None:
+            batch = _levels_and_dests(indent_arr, page_arr, indent_unit, page_offset, total_pages)
+        else:
+            dests = page_arr - 1 + page_offset
+            batch = (indent_arr // indent_unit, dests,
+                     (dests >= 0) & (dests < total_pages))
+
+    # 手工构建书签树，而不是逐条调用 writer.add_outline_item:
+    # 后者每次插入都要重新解析书签根、构造 GoTo 动作对象并沿祖先链
+    # 逐层回调计数，在部分版本中还会线性遍历兄弟链表 (最坏 O(N^2))。
+    # 这里按目录顺序直接生成 /Title、/Dest 字典并用下标互连兄弟/父子，
+    # /First、/Last、/Count 在循环结束后一次性回填
+    add_object = writer._add_object
+    pages = writer.pages
+    fit_name = NameObject('/Fit')
+    nodes = []        # 书签 DictionaryObject
+    node_refs = []    # 对应的 IndirectObject
+    node_parent = []  # 父节点下标，顶层为 -1
+    last_child = []   # 各节点当前最后一个子节点的下标
+    first_root = -1   # 第一个/最后一个顶层节点的下标
+    root_last = -1
+
+    for i, (line_num, indent_size, title, page_num) in enumerate(entries):
+        if batch is not None:
+            levels, dests, valid = batch
+            level = int(levels[i])
+            dest_page_index = int(dests[i])
+            in_range = bool(valid[i])
+        else:
+            level = level_of(indent_size)
+            dest_page_index = (page_num - 1) + page_offset
+            in_range = 0 <= dest_page_index < total_pages
 
-        # 2. 提取标题和页码
-        match = re.search(r'^(.*)\s+(\d+)$', stripped_line)
-        
-        if not match:
-            print(f"警告: 第 {line_num} 行格式不正确，已跳过: {stripped_line}")
-            continue
-            
-        title = match.group(1).strip()
-        page_num_str = match.group(2)
-        
-        # 3. 计算实际页码
-        # 逻辑页码 (书上印的) + 偏移量 = 物理页码 (PDF阅读器里的从0开始的索引)
-        # PyPDF2 的 add_outline_item 接受的页码索引从 0 开始
-        dest_page_index = (int(page_num_str) - 1) + page_offset
-        
         # 验证页码是否在有效范围内
-        if dest_page_index < 0 or dest_page_index >= total_pages:
-            print(f"警告: 第 {line_num} 行的页码 {page_num_str} 经偏移计算后得到的页面索引 {dest_page_index} 超出有效范围 [0, {total_pages-1}]，已跳过")
+        if not in_range:
+            log_append(f"警告: 第 {line_num} 行的页码 {page_num} 经偏移计算后得到的页面索引 {dest_page_index} 超出有效范围 [0, {total_pages-1}]，已跳过")
             continue
 
-        # 4. 查找父节点
-        parent = None
-        while parent_stack and parent_stack[-1][1] >= level:
-            parent_stack.pop()
-        
-        if parent_stack:
-            parent = parent_stack[-1][0]
-
-        # 5. 添加书签
-        bookmark = writer.add_outline_item(title, dest_page_index, parent=parent)
-        
-        # 将当前书签压入栈，作为潜在的父节点
-        parent_stack.append((bookmark, level))
-        
-        print(f"添加书签: {'  '*level} {title} -> Page {dest_page_index+1}")
+        # 3. 查找父节点
+        # 层级跳跃的不规则目录(如从 0 级直接跳到 2 级)按紧邻子级处理，
+        # 保证 parents[level-1] 始终是真实的最近祖先
+        if level > last_level + 1:
+            level = last_level + 1
+        p_idx = parents[level - 1] if level > 0 else -1
+
+        # 4. 生成书签节点并接入兄弟链
+        node = DictionaryObject()
+        node[NameObject('/Title')] = TextStringObject(title)
+        node[NameObject('/Dest')] = ArrayObject(
+            [pages[dest_page_index].indirect_reference, fit_name])
+        ref = add_object(node)
+        n_idx = len(nodes)
+
+        if p_idx < 0:
+            prev_idx = root_last
+            root_last = n_idx
+            if first_root < 0:
+                first_root = n_idx
+        else:
+            node[NameObject('/Parent')] = node_refs[p_idx]
+            prev_idx = last_child[p_idx]
+            last_child[p_idx] = n_idx
+        if prev_idx >= 0:
+            nodes[prev_idx][NameObject('/Next')] = ref
+            node[NameObject('/Prev')] = node_refs[prev_idx]
+        elif p_idx >= 0:
+            nodes[p_idx][NameObject('/First')] = ref
+
+        nodes.append(node)
+        node_refs.append(ref)
+        node_parent.append(p_idx)
+        last_child.append(-1)
+
+        # 记录当前书签下标，作为下一层的潜在父节点
+        if level >= len(parents):
+            parents.extend([None] * len(parents))
+        parents[level] = n_idx
+        last_level = level
+
+        log_append(f"添加书签: {'  '*level} {title} -> Page {dest_page_index+1}")
+
+    # 收尾: 自底向上回填各节点的 /Count、/Last，并把整棵树挂到书签根上
+    # (全部展开，/Count 为可见后代数; 倒序遍历保证子节点先于父节点累加)
+    if nodes:
+        outline_root = writer.get_outline_root()
+        root_ref = outline_root.indirect_reference
+        counts = [0] * len(nodes)
+        for n_idx in range(len(nodes) - 1, -1, -1):
+            p_idx = node_parent[n_idx]
+            if p_idx >= 0:
+                counts[p_idx] += counts[n_idx] + 1
+        root_count = 0
+        for n_idx, node in enumerate(nodes):
+            if node_parent[n_idx] < 0:
+                node[NameObject('/Parent')] = root_ref
+                root_count += counts[n_idx] + 1
+            if counts[n_idx]:
+                node[NameObject('/Count')] = NumberObject(counts[n_idx])
+                node[NameObject('/Last')] = node_refs[last_child[n_idx]]
+        outline_root[NameObject('/First')] = node_refs[first_root]
+        outline_root[NameObject('/Last')] = node_refs[root_last]
+        outline_root[NameObject('/Count')] = NumberObject(root_count)
+
+    if log_lines:
+        log_lines.append('')
+        sys.stdout.write('\n'.join(log_lines))
 
     # 保存文件
+    # 先写入同目录下的临时文件，成功后再用 os.replace 原子重命名:
+    # 目标位于网络盘/OneDrive 时顺序写临时文件更快，且崩溃或写入失败
+    # 不会留下半成品 PDF 覆盖目标文件
+    # PdfWriter.write 会对每个对象发起大量小块写入，使用 8MB 缓冲区
+    # 将它们合并成少量大块系统调用，显著加快大文件的保存阶段
+    tmp_path = None
     try:
-        with open(output_path, 'wb') as f_out:
+        with tempfile.NamedTemporaryFile(
+                'wb', buffering=8 * 1024 * 1024,
+                dir=output_dir or '.', suffix='.pdf', delete=False) as f_out:
+            tmp_path = f_out.name
             writer.write(f_out)
+        os.replace(tmp_path, output_path)
         print(f"\n完成! 文件已保存至: {output_path}")
     except Exception as e:
+        if tmp_path is not None:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
         raise IOError(f"无法写入输出文件 {output_path}: {str(e)}")
+    finally:
+        mm.close()
+        f_in.close()
 
 if __name__ == "__main__":
     # 检查命令行参数